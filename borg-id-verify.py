@@ -4,39 +4,51 @@
 # (C) Copyright 2025
 #
 # Written by        : Arno van Amersfoort
-# Dependencies      : subprocess, getopt, sys, os
-# Python Version    : 3
+# Dependencies      : subprocess, argparse, sys, os, hashlib, shutil, concurrent.futures
+# Python Version    : 3.9+
 # Initial date      : February 14, 2025
 # Last Modified     : November 17, 2025
 
-import subprocess
 import sys
 import os
-import getopt
 
 MY_VERSION = "1.01b"
+DEFAULT_JOBS = 8  # Default maximum number of concurrent "borg list" processes
+BORG_PIPE_BUFSIZE = 1 << 20  # Buffer size for reading "borg list" output
+MAX_COMPARE_ERRORS = 10  # Maximum number of missing/added IDs reported per repository
+ID_DIGEST_SIZE = 16  # Size (in bytes) of the ID file digests stored in the index file
+INDEX_FILENAME = ".borg-ids.index"  # Index file (in the Borg base path) holding the ID file digests/signatures of all repositories
 
 def printn_stdout(line):
   """ Print to stdout with linefeed """
+  sys.stderr.flush()  # Keep output ordered
   sys.stdout.write(line + "\n")
 
 
 def printn_stderr(line):
   """ Print to stderr with linefeed """
+  sys.stdout.flush()  # Keep output ordered
   sys.stderr.write(line + "\n")
 
 
+def flush_output():
+  """ Flush (buffered) stdout/stderr """
+  sys.stdout.flush()
+  sys.stderr.flush()
+
+
 class BorgIdVerify():
   """ Borg check class """
 
   def __init__(self):
     self._borg_base_path = None
     self._repo = None
-    self._file_id_info = []
-    self._borg_id_info = []
     self._force_update = False
     self._init = False
     self._dryrun = False
+    self._jobs = DEFAULT_JOBS
+    self._borg_binary = None
+    self._borg_env = None
 
   @staticmethod
   def print_version():
@@ -58,43 +70,29 @@ class BorgIdVerify():
     printn_stdout("--init|-i              - Init new repositories")
     printn_stdout("--repo=[repo]          - Only verify repository [repo]")
     printn_stdout("--dryrun|-n            - Do NOT write any files")
+    printn_stdout(f"--jobs|-j=[jobs]       - Run at most [jobs] Borg processes concurrently (default={DEFAULT_JOBS})")
     printn_stdout("")
 
 
-  def process_commandline(self, argv):
-    """ Process command line arguments (if any) """
-    try:
-      opts, args = getopt.getopt(argv, "hvnfi", ["help", "version", "dryrun", "force", "init", "repo="])
-    except getopt.GetoptError as err_msg:
-      printn_stderr(f"ERROR: {err_msg}")
-      return False
-
-    for option, value in opts:
-      if option in ("-h", "/h", "--help"):
-        self.print_version()
-        self.print_help()
-        return ""
-
-      if option in ("-v", "/v", "--version"):
-        self.print_version()
-        return ""
-
-      if option in ("-n", "--dryrun"):
-        self._dryrun = True
-
-      if option in ("-f", "--force"):
-        self._force_update = True
+  def process_commandline(self, args):
+    """ Process (parsed) command line arguments """
+    self._dryrun = args.dryrun
+    self._force_update = args.force
+    self._init = args.init
 
-      if option in ("-i", "--init"):
-        self._init = True
+    if args.repo is not None:
+      self._repo = args.repo.lower()
 
-      if option == "--repo":
-        self._repo = value.lower()
+    if args.jobs is not None:
+      if args.jobs < 1:
+        printn_stderr(f"ERROR: Invalid number of jobs \"{args.jobs}\"")
+        return False
+      self._jobs = args.jobs
 
     # Overwrite data-path?
-    if len(args) == 1:
-      self._borg_base_path = args[0]
-    elif len(args) > 1:
+    if len(args.borg_base_path) == 1:
+      self._borg_base_path = args.borg_base_path[0]
+    elif len(args.borg_base_path) > 1:
       printn_stderr("ERROR: Multiple non-option arguments are not allowed")
       return False
 
@@ -103,6 +101,8 @@ class BorgIdVerify():
 
   def sanity_check(self):
     """ Sanity check """
+    import shutil  # pylint: disable=import-outside-toplevel
+
     if self._borg_base_path is None:
       printn_stderr("ERROR: Need to specify Borg base path!")
       sys.exit(1)
@@ -111,142 +111,408 @@ class BorgIdVerify():
       printn_stderr(f"ERROR: Borg base path \"{self._borg_base_path}\" does not exist!")
       sys.exit(1)
 
+    # Resolve borg once, so its path isn't searched for every repository
+    self._borg_binary = shutil.which('borg')
+    if self._borg_binary is None:
+      printn_stderr("ERROR: Borg binary (borg) not found in PATH!")
+      sys.exit(1)
+
+    self._borg_env = {**os.environ, 'BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK': 'yes', 'BORG_RELOCATED_REPO_ACCESS_IS_OK': 'yes'}
+
     return True
 
 
-  def get_borg_id_info(self, repo_name):
+  def get_borg_id_info(self, repo_name, errors):
     """ Get ID info from borg using "borg list" """
-    self._borg_id_info = []
+    import subprocess  # pylint: disable=import-outside-toplevel
+
+    lines = []
 
     try:
-      result = subprocess.run(['borg', 'list', repo_name],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              env={'BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK': 'yes', 'BORG_RELOCATED_REPO_ACCESS_IS_OK': 'yes'},
-                              check=False)
-    except subprocess.CalledProcessError:
-      printn_stderr("ERROR: Borg execution failed")
-      return False
+      with subprocess.Popen([self._borg_binary, 'list', repo_name],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            bufsize=BORG_PIPE_BUFSIZE,
+                            env=self._borg_env) as proc:
+        # Keep IDs as (undecoded) bytes, they're only compared and written back to file
+        lines = [ line.rstrip(b'\n') for line in proc.stdout ]
+    except OSError:
+      errors.append("ERROR: Borg execution failed")
+      return None
 
-    if result.returncode != 0:
-      printn_stderr(f"ERROR: Borg failed with code {result.returncode}")
-      for line in result.stdout.splitlines():
-        printn_stderr(line.decode('utf-8'))
-      return False
+    if proc.returncode != 0:
+      errors.append(f"ERROR: Borg failed with code {proc.returncode}")
+      errors.extend(line.decode('utf-8', errors='replace') for line in lines)
+      return None
 
-    self._borg_id_info = [ line.decode('utf-8') for line in result.stdout.splitlines() if not line.startswith(b'Removed stale shared roster lock') ]
+    return [ line for line in lines if not line.startswith(b'Removed stale shared roster lock') ]
 
-    return True
+
+  @staticmethod
+  def read_id_file(id_filename, errors):
+    """ Read (hash) info from repo info file, returns its (binary) content """
+    try:
+      with open(id_filename, 'rb') as file_handle:
+        return file_handle.read()
+    except IOError:
+      errors.append(f"ERROR: Reading Borg-id file {id_filename} failed")
+      return None
+
+
+  @staticmethod
+  def id_file_content(id_info):
+    """ Return the (binary) ID file content for the given IDs """
+    if not id_info:
+      return b""
+
+    return b"\n".join(id_info) + b"\n"
 
 
-  def read_id_file(self, id_filename):
-    """ Read (hash) info from repo info file """
-    self._file_id_info = []
+  @staticmethod
+  def id_digest(content):
+    """ Return the hex digest of (binary) ID file content """
+    import hashlib  # pylint: disable=import-outside-toplevel
+
+    return hashlib.blake2b(content, digest_size=ID_DIGEST_SIZE).hexdigest()
+
 
+  @staticmethod
+  def id_file_signature(id_filename):
+    """ Return (size, mtime, inode) of an ID file, used to detect changes since its digest was stored """
     try:
-      with open(id_filename, 'r', encoding='ascii') as file_handle:
-        self._file_id_info = [ line.strip('\n') for line in file_handle ]
-      return True
+      stat_result = os.stat(id_filename)
+    except OSError:
+      return None
+
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+
+
+  @staticmethod
+  def read_index_file(index_filename):
+    """ Read stored ID digests (and ID file signatures) of all repos from base index file (if any) """
+    index = {}
+    try:
+      with open(index_filename, 'r', encoding='utf-8', errors='surrogateescape') as file_handle:
+        for line in file_handle.read().splitlines():
+          fields = line.split(" ", 4)
+          if len(fields) != 5:
+            continue  # Ignore malformed (or old format) entries
+
+          digest, size, mtime, inode, folder = fields
+          try:
+            index[folder] = (digest, (int(size), int(mtime), int(inode)))
+          except ValueError:
+            continue
     except IOError:
-      printn_stderr(f"ERROR: Reading Borg-id file {id_filename} failed")
+      pass  # No (readable) index, fall back to digesting the ID files
+
+    return index
+
+
+  @staticmethod
+  def write_file_atomic(filename, content, backup_filename=None):
+    """ Write (binary) content to file via a synced temporary file that's renamed into place """
+    import shutil  # pylint: disable=import-outside-toplevel
+
+    tmp_filename = f"{filename}.tmp"
+
+    try:
+      fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+      try:
+        view = memoryview(content)
+        while view:
+          view = view[os.write(fd, view):]
+        getattr(os, 'fdatasync', os.fsync)(fd)
+      finally:
+        os.close(fd)
+
+      # Back up using a hard link, so the file itself is never absent
+      if backup_filename is not None:
+        try:
+          os.unlink(backup_filename)
+        except FileNotFoundError:
+          pass
+
+        try:
+          os.link(filename, backup_filename)
+        except FileNotFoundError:
+          pass  # File vanished since it was enumerated, nothing to back up
+        except OSError:
+          shutil.copy2(filename, backup_filename)  # Filesystem without hard link support
+
+      os.replace(tmp_filename, filename)
+    except OSError:
+      try:
+        os.unlink(tmp_filename)
+      except OSError:
+        pass
+      raise
+
+
+  def write_index_file(self, index_filename, index):
+    """ Write ID digests of all repos to base index file """
+    content = "".join(f"{digest} {size} {mtime} {inode} {folder}\n"
+                      for folder, (digest, (size, mtime, inode)) in sorted(index.items()))
+
+    try:
+      self.write_file_atomic(index_filename, content.encode('utf-8', errors='surrogateescape'))
+    except OSError:
+      printn_stderr(f"WARNING: Writing borg-id index file {index_filename} failed, ID files will be digested (again) on the next run")
       return False
 
+    return True
+
 
-  def write_id_file(self, id_filename):
+  def write_id_file(self, id_filename, id_info, keep_old=False):
     """ Write (hash) info from repo info file """
     try:
-      with open(id_filename, 'w', encoding='ascii') as file_handle:
-        for line in self._borg_id_info:
-          file_handle.write(f"{line}\n")
-      return True
-    except IOError:
+      self.write_file_atomic(id_filename, self.id_file_content(id_info), f"{id_filename}.old" if keep_old else None)
+    except OSError:
       printn_stderr(f"ERROR: Writing borg-id file {id_filename} failed")
       return False
 
+    return True
 
-  def compare_ids(self):
+
+  @staticmethod
+  def compare_ids(file_id_info, borg_id_info):
     """ Compare the obtained BORG IDs with the ones stored in file """
-    ret = True
-    for idx, file_id in enumerate(self._file_id_info):
-      if idx >= len(self._borg_id_info):
-        printn_stderr(f"ERROR: Reached end of Borg-info before reaching end of ID-file at line {idx + 1}:")
-        printn_stderr(f"* File={file_id}")
-        ret = False
-        break  # No point in continuing
-      elif self._borg_id_info[idx] != file_id:
-        printn_stderr(f"ERROR: Compare failed at file line {idx + 1}:")
-        printn_stderr(f"* File={file_id}")
-        printn_stderr(f"* Repo={self._borg_id_info[idx]}")
-        ret = False
-
-    return ret
+    # Fast path: stored IDs are unchanged (Borg may have appended new ones)
+    if borg_id_info[:len(file_id_info)] == file_id_info:
+      return True
+
+    # Report which stored IDs are missing from and which IDs were added to the repository (at most MAX_COMPARE_ERRORS each)
+    file_set = set(file_id_info)
+    repo_set = set(borg_id_info)
+    missing = file_set - repo_set
+    added = repo_set - file_set
+
+    if missing:
+      printn_stderr(f"ERROR: {len(missing)} ID(s) from ID-file missing in Borg-info:")
+      for file_id in [ file_id for file_id in file_id_info if file_id in missing ][:MAX_COMPARE_ERRORS]:
+        printn_stderr(f"* File={file_id.decode('utf-8', errors='replace')}")
+      if len(missing) > MAX_COMPARE_ERRORS:
+        printn_stderr(f"* ... ({len(missing) - MAX_COMPARE_ERRORS} more)")
+
+    # Added IDs alone are just new archives, only report them when they (may) have replaced stored ones
+    if added and missing:
+      printn_stderr(f"ERROR: {len(added)} ID(s) in Borg-info not present in ID-file:")
+      for borg_id in [ borg_id for borg_id in borg_id_info if borg_id in added ][:MAX_COMPARE_ERRORS]:
+        printn_stderr(f"* Repo={borg_id.decode('utf-8', errors='replace')}")
+      if len(added) > MAX_COMPARE_ERRORS:
+        printn_stderr(f"* ... ({len(added) - MAX_COMPARE_ERRORS} more)")
+
+    if not missing:
+      # All stored IDs still exist, so they've been reordered (or new IDs were inserted in between)
+      for idx, (file_id, borg_id) in enumerate(zip(file_id_info, borg_id_info)):
+        if file_id != borg_id:
+          printn_stderr(f"ERROR: ID order differs, first at file line {idx + 1}:")
+          printn_stderr(f"* File={file_id.decode('utf-8', errors='replace')}")
+          printn_stderr(f"* Repo={borg_id.decode('utf-8', errors='replace')}")
+          break
+      else:
+        # Overlapping lines are identical, so Borg-info is shorter (e.g. due to duplicate lines in the ID-file)
+        printn_stderr(f"ERROR: ID count mismatch: ID-file has {len(file_id_info)} ID(s), Borg-info has {len(borg_id_info)}")
+
+    return False
+
+
+  def _scan_repo(self, folder, id_file_exists, index_entry):
+    """ Obtain ID-file and Borg ID info (and the latter's digest) for a single repository (thread-safe) """
+    full_dir = os.path.join(self._borg_base_path, folder)
+    id_file = os.path.join(self._borg_base_path, f".{folder}.id")
+
+    errors = []
+    file_id_info = None
+    borg_id_info = None
+    borg_digest = None
+    id_file_sig = None
+
+    if id_file_exists:
+      borg_id_info = self.get_borg_id_info(full_dir, errors)
+      if borg_id_info is not None:
+        borg_digest = self.id_digest(self.id_file_content(borg_id_info))
+
+      # With --force the ID file isn't verified, so don't bother reading it
+      if borg_id_info is not None and not self._force_update:
+        # Fast path: when Borg's IDs match the stored digest there's no need to read/compare the ID file.
+        # The index digest is only trusted when the ID file is unmodified since, else read (and digest) the ID file itself
+        id_file_sig = self.id_file_signature(id_file)
+        if index_entry is not None and id_file_sig is not None and index_entry[1] == id_file_sig and index_entry[0] == borg_digest:
+          file_id_info = borg_id_info
+        else:
+          content = self.read_id_file(id_file, errors)
+          if content is None:
+            borg_id_info = None
+          elif self.id_digest(content) == borg_digest:
+            file_id_info = borg_id_info
+          else:
+            file_id_info = content.splitlines()
+    elif self._init:
+      borg_id_info = self.get_borg_id_info(full_dir, errors)
+      if borg_id_info is not None:
+        borg_digest = self.id_digest(self.id_file_content(borg_id_info))
+
+    return folder, file_id_info, borg_id_info, borg_digest, id_file_sig, errors
 
 
   def check_repos(self):
     """ Check all repositories """
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
     self.print_version()
 
     ret_code = 0
 
-    if self._repo is None:
-      folders = [f for f in os.listdir(self._borg_base_path) if os.path.isdir(os.path.join(self._borg_base_path, f))]
-    else:
+    # Enumerate the base path once, this also tells us which ID files exist (without additional stat() calls)
+    folders = []
+    base_files = set()
+    with os.scandir(self._borg_base_path) as dir_entries:
+      for entry in dir_entries:
+        if entry.is_dir():
+          folders.append(entry.name)
+        elif entry.is_file():
+          base_files.add(entry.name)
+
+    if self._repo is not None:
       folders = [ self._repo ]
 
-    for folder in folders:
-      full_dir = os.path.join(self._borg_base_path, folder)
-      id_file = os.path.join(self._borg_base_path, f".{folder}.id")
+    # The stored ID digests of all repositories are kept in a single index file
+    index_file = os.path.join(self._borg_base_path, INDEX_FILENAME)
+    index = self.read_index_file(index_file)
+    index_changed = False
 
-      printn_stdout(f"* Checking Borg path \"{full_dir}\"...")
+    # Run "borg list" for all repositories concurrently, but process the results in order
+    with ThreadPoolExecutor(max_workers=max(1, min(self._jobs, len(folders)))) as executor:
+      futures = [ executor.submit(self._scan_repo, folder, f".{folder}.id" in base_files, index.get(folder)) for folder in folders ]
 
-      write_file = False
+      try:
+        for future in futures:
+          folder, file_id_info, borg_id_info, borg_digest, id_file_sig, errors = future.result()
 
-      if not os.path.isfile(id_file):
-        if not self._init:
-          printn_stderr(f"ERROR: Borg-id file {id_file} does not exist (yet). If this is the first run, use --init")
-          printn_stdout("")
-          continue
-        else:
-          printn_stdout(f"WARNING: Borg-id file {id_file} does not exist (yet). Creating one since --init is specified")
-          self.get_borg_id_info(full_dir)
-          write_file = True
-      elif self.read_id_file(id_file) and self.get_borg_id_info(full_dir) and self._file_id_info:
-        if self._force_update:
-          write_file = True
-          printn_stdout("NOTE: --force specified, not verifying IDs")
-        else:
-          if self.compare_ids():
-            if len(self._borg_id_info) != len(self._file_id_info):
+          full_dir = os.path.join(self._borg_base_path, folder)
+          id_file = os.path.join(self._borg_base_path, f".{folder}.id")
+
+          printn_stdout(f"* Checking Borg path \"{full_dir}\"...")
+
+          for line in errors:
+            printn_stderr(line)
+
+          write_file = False
+
+          id_file_exists = f".{folder}.id" in base_files
+          if not id_file_exists:
+            if not self._init:
+              printn_stderr(f"ERROR: Borg-id file {id_file} does not exist (yet). If this is the first run, use --init")
+              printn_stdout("")
+              flush_output()
+              continue
+            else:
+              printn_stdout(f"WARNING: Borg-id file {id_file} does not exist (yet). Creating one since --init is specified")
+              write_file = borg_id_info is not None
+          elif self._force_update:
+            if borg_id_info is not None:
               write_file = True
+              printn_stdout("NOTE: --force specified, not verifying IDs")
+          elif file_id_info and borg_id_info is not None:
+            if self.compare_ids(file_id_info, borg_id_info):
+              if len(borg_id_info) != len(file_id_info):
+                write_file = True
+              else:
+                write_file = False
+                printn_stdout("NOTE: Not updating ID file due to no changes")
+                if id_file_sig is not None and index.get(folder) != (borg_digest, id_file_sig) and not self._dryrun:
+                  index[folder] = (borg_digest, id_file_sig)
+                  index_changed = True
             else:
-              write_file = False
-              printn_stdout("NOTE: Not updating ID file due to no changes")
-          else:
-            ret_code = 1
-            printn_stderr(f"ERROR: Verification for Borg repository \"{full_dir}\" failed. Not updating ID file!")
+              ret_code = 1
+              printn_stderr(f"ERROR: Verification for Borg repository \"{full_dir}\" failed. Not updating ID file!")
 
-      if write_file:
-        if self._dryrun:
-          printn_stdout("NOTE: Skipping updating ID file due to --dryrun")
-        else:
-          if os.path.isfile(id_file):
-            old_id_file = f"{id_file}.old"
-            if os.path.isfile(old_id_file):
-              os.remove(old_id_file)
-            os.rename(id_file, old_id_file)
+          if write_file:
+            if self._dryrun:
+              printn_stdout("NOTE: Skipping updating ID file due to --dryrun")
+            else:
+              printn_stdout("* Writing (new) ID file...")
+              # Drop the outdated index entry, it's only re-added once the new ID file is written
+              index.pop(folder, None)
+              index_changed = True
+              if self.write_id_file(id_file, borg_id_info, keep_old=id_file_exists):
+                id_file_sig = self.id_file_signature(id_file)
+                if id_file_sig is not None:
+                  index[folder] = (borg_digest, id_file_sig)
+              else:
+                ret_code = 1
 
-          printn_stdout("* Writing (new) ID file...")
-          self.write_id_file(id_file)
+          printn_stdout("")
+          flush_output()
+      except BaseException:
+        # Don't start "borg list" for all remaining repositories on errors/interrupts (e.g. Ctrl-C)
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
 
-      printn_stdout("")
+    # The index is only a cache, failing to update it doesn't affect verification
+    if index_changed:
+      self.write_index_file(index_file, index)
 
     sys.exit(ret_code)
 
 
+def parse_commandline(argv):
+  """ Parse command line arguments, returns None on error """
+  import argparse  # pylint: disable=import-outside-toplevel
+
+  # Help is shown by BorgIdVerify.print_help() and errors are reported by us, not by argparse
+  parser = argparse.ArgumentParser(add_help=False, allow_abbrev=True, exit_on_error=False)
+  parser.add_argument("-h", "--help", action="store_true")
+  parser.add_argument("-v", "--version", action="store_true")
+  parser.add_argument("-n", "--dryrun", action="store_true")
+  parser.add_argument("-f", "--force", action="store_true")
+  parser.add_argument("-i", "--init", action="store_true")
+  parser.add_argument("--repo")
+  parser.add_argument("-j", "--jobs", type=int)
+  parser.add_argument("borg_base_path", nargs="*")
+
+  try:
+    args, unknown = parser.parse_known_args(argv)
+  except argparse.ArgumentError as err_msg:
+    printn_stderr(f"ERROR: {err_msg}")
+    return None
+
+  if unknown:
+    printn_stderr(f"ERROR: Unrecognized option(s): {' '.join(unknown)}")
+    return None
+
+  return args
+
+
 def main(argv):
   """ Main program """
+  # Don't flush output per line, check_repos() flushes per repository instead
+  for stream in (sys.stdout, sys.stderr):
+    if hasattr(stream, 'reconfigure'):
+      stream.reconfigure(line_buffering=False)
+
+  # Fast path: show version without processing the command line (and importing its dependencies)
+  if argv in (["--version"], ["-v"]):
+    BorgIdVerify.print_version()
+    return
+
+  args = parse_commandline(argv)
+  if args is None:
+    return
+
+  # Handle help/version before setting up anything else
+  if args.help:
+    BorgIdVerify.print_version()
+    BorgIdVerify.print_help()
+    return
+
+  if args.version:
+    BorgIdVerify.print_version()
+    return
+
   app = BorgIdVerify()
-  if app.process_commandline(argv) and app.sanity_check():
+  if app.process_commandline(args) and app.sanity_check():
     app.check_repos()
 
 